@@ -1,9 +1,19 @@
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+import re
+import sqlite3
 import time
+from bisect import bisect_right
+from collections import deque
 import threading
 import logging
+import math
 import os
+import queue
 from dotenv import load_dotenv
 
 # Configure logging
@@ -16,55 +26,505 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+WORLDCOIN_ID = 'world-coin'
+COINGECKO_PRICE_URL = 'https://api.coingecko.com/api/v3/simple/price'
+COINGECKO_MAX_IDS = 250  # Coins per request, keeps the URL within CoinGecko's limits
+MAX_MESSAGE_LENGTH = 4096  # Telegram's limit for a single text message
+WARMING_UP_MESSAGE = "Warming up, try again in a moment."
+COMMAND_RE = re.compile(
+    r'^/(start|track|stop|price|setalert|alerts|trend|stats)(?:@\w+)?(?:\s+(.*))?$',
+    re.DOTALL
+)
+JSON_NUMBER_RE = re.compile(rb'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?')
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        """
+        Thread-safe token bucket used to pace outgoing messages
+        
+        :param rate: Tokens added per second
+        :param capacity: Maximum number of tokens (burst size)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """
+        Take one token, blocking until one is available
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
 class WorldcoinTelegramBot:
-    def __init__(self, bot_token):
+    def __init__(self, bot_token, num_threads=8, db_path='bot.db', sender_threads=4):
         """
         Initialize Worldcoin Telegram Bot with improved error handling
         
         :param bot_token: Telegram Bot Token from BotFather
+        :param num_threads: Number of worker threads handling incoming updates
+        :param db_path: SQLite database file used to persist users and alerts
+        :param sender_threads: Number of threads delivering queued notifications
         """
         # Configure bot with custom exceptions and connection parameters
         self.bot = TeleBot(
             token=bot_token, 
             parse_mode=None,
             threaded=True,
-            num_threads=2,
+            num_threads=num_threads,
             skip_pending=True
         )
         
         self.tracking_users = {}  # Store users and their tracking preferences
+        self._users_lock = threading.RLock()  # Guards mutations of tracking_users
+        self._min_notify_floor = float('inf')  # Lowest last_notification_price of any user
+        # Pending alerts across all users, kept sorted by target price so a
+        # poll only has to look at the alerts the current price has reached
+        self._alert_targets = []  # Sorted target prices
+        self._alert_entries = []  # (user_id, alert) matching _alert_targets
+        self._alerts_lock = threading.Lock()
         self.price_check_interval = 60  # Check price every minute
+        self.notification_min_interval = 10 * 60  # Minimum seconds between $1 increase notices per user
         self.bot_token = bot_token
-        self.price_history = []  # Store recent price history for trends
+        self.price_history = deque(maxlen=24)  # Store recent price history for trends
+        self._stats_cache = None  # Summary of price_history, refreshed on each new sample
+        self._trend_label = None  # Trend description, refreshed on each new sample
+        self.price_cache_ttl = 300  # Seconds before a cached price is considered stale
+        # Written only by the price check thread, read by everything else
+        self._price_cache = {}  # Coin ID -> (price, monotonic time it was fetched)
+        self.tracked_ids = {WORLDCOIN_ID}  # CoinGecko IDs fetched on every poll
+        
+        # Reuse connections to CoinGecko and back off on rate limiting
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504]
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+        self.http = requests.Session()
+        self.http.mount('https://', adapter)
+        
+        # Stay under Telegram's limits of 30 messages/s overall and 1/s per chat
+        self._bot_bucket = TokenBucket(rate=30, capacity=30)
+        self._chat_buckets = {}
+        self._chat_buckets_lock = threading.Lock()
+        
+        # Notifications are queued by the price check and delivered by sender threads.
+        # Each chat always goes through the same queue and thread, so its
+        # messages are delivered in the order they were queued. A blocking
+        # sendMessage takes around 100 ms, so the default of 4 threads already
+        # keeps up with Telegram's 30 msg/s bot-wide limit.
+        self._outboxes = [
+            queue.Queue(maxsize=max(1, 1000 // sender_threads))
+            for _ in range(sender_threads)
+        ]
+        
+        # Background threads started by run(), stopped and joined by close()
+        self._price_stop = threading.Event()
+        self._senders_stop = threading.Event()
+        self._price_thread = None
+        self._sender_threads = []
+        self.shutdown_timeout = 10  # Seconds close() waits for queued messages to go out
+        
+        # Persist users and alerts so they survive restarts
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self._init_db()
+        self._load_state()
+        
+    def _init_db(self):
+        """
+        Configure the SQLite connection and create tables if needed
+        """
+        with self._db_lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    last_notification_price REAL NOT NULL,
+                    last_notification_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS alerts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL REFERENCES users(user_id),
+                    target REAL NOT NULL,
+                    triggered INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS alerts_user_id ON alerts(user_id);
+            """)
+            
+            # Databases created before last_notification_at existed lack the column
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(users)")]
+            if 'last_notification_at' not in columns:
+                self.db.execute("ALTER TABLE users ADD COLUMN last_notification_at REAL")
+    
+    def _load_state(self):
+        """
+        Load tracked users and their alerts from the database into memory
+        """
+        with self._db_lock:
+            users = self.db.execute(
+                "SELECT user_id, last_notification_price, last_notification_at FROM users"
+            ).fetchall()
+            alerts = self.db.execute(
+                "SELECT id, user_id, target, triggered FROM alerts ORDER BY id"
+            ).fetchall()
+        
+        for user_id, last_notification_price, last_notification_at in users:
+            self.tracking_users[user_id] = {
+                'tracking': True,
+                'last_notification_price': last_notification_price,
+                'last_notification_at': last_notification_at,
+                'alerts': []
+            }
+        
+        for alert_id, user_id, target, triggered in alerts:
+            if user_id not in self.tracking_users:
+                continue
+            alert = {'id': alert_id, 'target': target, 'triggered': bool(triggered)}
+            self.tracking_users[user_id]['alerts'].append(alert)
+            if not alert['triggered']:
+                self._index_alert(user_id, alert)
+        
+        self._update_notify_floor()
+        logger.info("Loaded %s tracked users and %s alerts", len(users), len(alerts))
+    
+    def _db_execute(self, sql, params=()):
+        """
+        Run a write statement against the database in its own transaction
         
+        :return: sqlite3 cursor for the statement
+        """
+        with self._db_lock, self.db:
+            return self.db.execute(sql, params)
+    
+    def _db_executemany(self, sql, seq_of_params):
+        """
+        Run a write statement for each parameter set in a single transaction
+        """
+        with self._db_lock, self.db:
+            self.db.executemany(sql, seq_of_params)
+    
+    def _add_user(self, user_id, last_notification_price):
+        """
+        Register a tracked user in memory and in the database
+        """
+        self._db_execute(
+            "INSERT OR REPLACE INTO users (user_id, last_notification_price) VALUES (?, ?)",
+            (user_id, last_notification_price)
+        )
+        self.tracking_users[user_id] = {
+            'tracking': True,
+            'last_notification_price': last_notification_price,
+            'last_notification_at': None,
+            'alerts': []
+        }
+        self._min_notify_floor = min(self._min_notify_floor, last_notification_price)
+    
+    def _update_notify_floor(self):
+        """
+        Recompute the lowest notification price across tracked users
+        """
+        with self._users_lock:
+            self._min_notify_floor = min(
+                (user['last_notification_price'] for user in self.tracking_users.values()),
+                default=float('inf')
+            )
+    
+    def _index_alert(self, user_id, alert):
+        """
+        Add a pending alert to the sorted global alert index
+        """
+        with self._alerts_lock:
+            idx = bisect_right(self._alert_targets, alert['target'])
+            self._alert_targets.insert(idx, alert['target'])
+            self._alert_entries.insert(idx, (user_id, alert))
+    
+    def get_price(self, coin_id):
+        """
+        Get the latest price of a coin fetched by the price check thread
+        
+        :param coin_id: CoinGecko coin ID, e.g. 'world-coin'
+        :return: Price in USD or None if not available yet
+        """
+        entry = self._price_cache.get(coin_id)
+        if entry and time.monotonic() - entry[1] < self.price_cache_ttl:
+            return entry[0]
+        return None
+    
     def get_worldcoin_price(self):
         """
-        Fetch current Worldcoin price from CoinGecko with improved error handling
+        Get the latest Worldcoin price fetched by the price check thread
+        
+        :return: Current price of Worldcoin in USD or None if not available yet
+        """
+        return self.get_price(WORLDCOIN_ID)
+    
+    def refresh_price(self):
+        """
+        Fetch fresh prices for all tracked coins and publish them to the shared cache
         
         :return: Current price of Worldcoin in USD or None if failed
         """
-        try:
-            url = 'https://api.coingecko.com/api/v3/simple/price?ids=world-coin&vs_currencies=usd'
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()  # Raise exception for bad responses
-            data = response.json()
-            if 'world-coin' in data and 'usd' in data['world-coin']:
-                return data['world-coin']['usd']
-            logger.error("Unexpected API response format")
+        prices = self.fetch_prices(self.tracked_ids)
+        if prices:
+            # Merge into a copy and swap it in one step, so readers never see a
+            # half update and coins from a failed chunk keep their last price
+            fetched_at = time.monotonic()
+            cache = dict(self._price_cache)
+            cache.update((coin_id, (price, fetched_at)) for coin_id, price in prices.items())
+            self._price_cache = cache
+        return prices.get(WORLDCOIN_ID)
+    
+    def fetch_prices(self, coin_ids):
+        """
+        Fetch USD prices for several coins from CoinGecko with improved error handling
+        
+        Coins are requested together, in as few calls as CoinGecko allows.
+        
+        :param coin_ids: Iterable of CoinGecko coin IDs
+        :return: Dict mapping coin ID to price in USD; coins that failed are missing
+        """
+        coin_ids = sorted(coin_ids)
+        prices = {}
+        for start in range(0, len(coin_ids), COINGECKO_MAX_IDS):
+            chunk = coin_ids[start:start + COINGECKO_MAX_IDS]
+            try:
+                response = self.http.get(
+                    COINGECKO_PRICE_URL,
+                    params={'ids': ','.join(chunk), 'vs_currencies': 'usd'},
+                    timeout=(3.05, 7)
+                )
+                response.raise_for_status()  # Raise exception for bad responses
+                if len(chunk) == 1:
+                    price = self.parse_single_price(response.content, chunk[0])
+                    if price is not None:
+                        prices[chunk[0]] = price
+                        continue
+                
+                data = orjson.loads(response.content)
+                for coin_id in chunk:
+                    if coin_id in data and 'usd' in data[coin_id]:
+                        prices[coin_id] = data[coin_id]['usd']
+                    else:
+                        logger.error("Unexpected API response format for %s", coin_id)
+            except requests.RequestException as e:
+                logger.error("Price fetch error: %s", e)
+            except orjson.JSONDecodeError as e:
+                logger.error("Invalid price response: %s", e)
+            except Exception as e:
+                logger.error("Unexpected error fetching price: %s", e)
+        return prices
+    
+    @staticmethod
+    def parse_single_price(content, coin_id):
+        """
+        Read the USD price straight from a single-coin /simple/price response
+        
+        Relies on CoinGecko's compact response shape {"<coin_id>":{"usd":<number>}}
+        and avoids building a dict for it.
+        
+        :param content: Raw response body
+        :param coin_id: CoinGecko coin ID that was requested
+        :return: Price in USD, or None if the body doesn't have the expected shape
+        """
+        prefix = b'{"' + coin_id.encode() + b'":{"usd":'
+        if not content.startswith(prefix):
             return None
-        except requests.RequestException as e:
-            logger.error(f"Price fetch error: {e}")
+        end = content.find(b'}', len(prefix))
+        if end == -1:
             return None
-        except Exception as e:
-            logger.error(f"Unexpected error fetching price: {e}")
+        # float() also accepts nan, inf and 1_000, which aren't JSON numbers
+        number = content[len(prefix):end]
+        if not JSON_NUMBER_RE.fullmatch(number):
             return None
+        price = float(number)
+        return price if math.isfinite(price) else None
+    
+    def _send(self, chat_id, text, max_retries=3):
+        """
+        Send a message to a chat while respecting Telegram rate limits
+        
+        :param chat_id: Telegram chat ID
+        :param text: Message text
+        :param max_retries: How many times to retry after a 429 response
+        """
+        with self._chat_buckets_lock:
+            chat_bucket = self._chat_buckets.get(chat_id)
+            if chat_bucket is None:
+                chat_bucket = self._chat_buckets[chat_id] = TokenBucket(rate=1, capacity=1)
+        
+        for attempt in range(max_retries + 1):
+            # Wait on the chat first so a slow chat doesn't hold bot-wide tokens
+            chat_bucket.acquire()
+            self._bot_bucket.acquire()
+            try:
+                return self.bot.send_message(chat_id, text)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt == max_retries:
+                    raise
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                logger.warning("Rate limited sending to %s, retrying in %ss", chat_id, retry_after)
+                time.sleep(retry_after)
+    
+    def _enqueue(self, chat_id, texts, undo):
+        """
+        Queue messages for a chat, dropping the oldest queued batch when full
+        
+        :param chat_id: Telegram chat ID
+        :param texts: List of message texts, delivered in order
+        :param undo: Notification state to restore if the batch is never delivered
+        """
+        outbox = self._outboxes[chat_id % len(self._outboxes)]
+        while True:
+            try:
+                outbox.put_nowait((chat_id, texts, undo))
+                return
+            except queue.Full:
+                try:
+                    dropped_chat_id, _, dropped_undo = outbox.get_nowait()
+                    outbox.task_done()
+                    logger.warning("Outbox full, dropped pending messages for %s", dropped_chat_id)
+                    self._undo_notification(dropped_chat_id, dropped_undo)
+                except queue.Empty:
+                    pass
+    
+    def _undo_notification(self, user_id, undo):
+        """
+        Restore a user's notification state after their batch was not delivered
+        
+        Puts back the previous $1 notice price and time, unless a newer notice has
+        been recorded since, and re-arms the custom alerts the batch carried so
+        the next poll tries again.
+        
+        :param user_id: Telegram user ID
+        :param undo: State captured when the batch was queued
+        """
+        with self._users_lock:
+            user_data = self.tracking_users.get(user_id)
+            if user_data is None:
+                return  # Stopped tracking in the meantime
+            
+            if undo['notified_at'] is not None and user_data['last_notification_at'] == undo['notified_at']:
+                user_data['last_notification_price'] = undo['price']
+                user_data['last_notification_at'] = undo['at']
+                self._db_execute(
+                    "UPDATE users SET last_notification_price = ?, last_notification_at = ? "
+                    "WHERE user_id = ?",
+                    (undo['price'], undo['at'], user_id)
+                )
+                self._update_notify_floor()
+            
+            alerts = [alert for alert in undo['alerts'] if alert['triggered']]
+            for alert in alerts:
+                alert['triggered'] = False
+                self._index_alert(user_id, alert)
+            if alerts:
+                self._db_executemany(
+                    "UPDATE alerts SET triggered = 0 WHERE id = ?",
+                    [(alert['id'],) for alert in alerts]
+                )
+    
+    def _sender_loop(self, outbox):
+        """
+        Deliver messages from one outbox queue until the bot is closed
+        
+        :param outbox: Queue of (chat_id, texts, undo) batches owned by this thread
+        """
+        while not self._senders_stop.is_set():
+            try:
+                chat_id, texts, undo = outbox.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                for text in texts:
+                    self._send(chat_id, text)
+            except Exception as send_error:
+                logger.error("Message send error to %s: %s", chat_id, send_error)
+                self._undo_notification(chat_id, undo)
+            finally:
+                outbox.task_done()
+    
+    @staticmethod
+    def join_messages(parts, limit=MAX_MESSAGE_LENGTH):
+        """
+        Join message parts into as few Telegram messages as possible
+        
+        :param parts: List of message texts
+        :param limit: Maximum length of a single message
+        :return: List of message texts no longer than limit
+        """
+        chunks = []
+        current = ""
+        for part in parts:
+            # Hard-split any single part that cannot fit in one message
+            pieces = [part[i:i + limit] for i in range(0, len(part), limit)] or [""]
+            for piece in pieces:
+                if current and len(current) + 2 + len(piece) <= limit:
+                    current += "\n\n" + piece
+                else:
+                    if current:
+                        chunks.append(current)
+                    current = piece
+        if current:
+            chunks.append(current)
+        return chunks
+    
+    def close(self):
+        """
+        Stop background threads and release network and database resources
+        """
+        deadline = time.monotonic() + self.shutdown_timeout
+        
+        # Stop producing notifications first
+        self._price_stop.set()
+        if self._price_thread is not None:
+            self._price_thread.join(timeout=max(0, deadline - time.monotonic()))
+        
+        # Give the senders until the deadline to deliver what is already queued
+        while time.monotonic() < deadline and any(outbox.unfinished_tasks for outbox in self._outboxes):
+            time.sleep(0.1)
+        self._senders_stop.set()
+        for thread in self._sender_threads:
+            thread.join(timeout=max(0, deadline - time.monotonic()))
+        
+        # Whatever is still queued was never delivered
+        for outbox in self._outboxes:
+            while True:
+                try:
+                    chat_id, _, undo = outbox.get_nowait()
+                except queue.Empty:
+                    break
+                outbox.task_done()
+                self._undo_notification(chat_id, undo)
+        
+        self.http.close()
+        with self._db_lock:
+            self.db.close()
     
     def get_price_trend(self):
+        """
+        Return the price trend computed by record_price
+        """
+        return self._trend_label or "Insufficient data for trend analysis"
+    
+    def _compute_trend_label(self):
         """
         Calculate price trend based on recent history
         """
         if len(self.price_history) < 2:
-            return "Insufficient data for trend analysis"
+            return None
             
         last_price = self.price_history[-1]
         prev_price = self.price_history[0]
@@ -84,58 +544,88 @@ class WorldcoinTelegramBot:
     def set_price_alert(self, user_id, target_price):
         """
         Set custom price alert for user
+        
+        :return: True if the alert was set, False if the price is unavailable
         """
-        if user_id not in self.tracking_users:
-            self.tracking_users[user_id] = {
-                'tracking': True,
-                'last_notification_price': int(self.get_worldcoin_price()),
-                'alerts': []
+        with self._users_lock:
+            if user_id not in self.tracking_users:
+                price = self.get_worldcoin_price()
+                if price is None:
+                    return False
+                
+                self._add_user(user_id, float(price))
+            
+            alert = {
+                'target': float(target_price),
+                'triggered': False
             }
+            cursor = self._db_execute(
+                "INSERT INTO alerts (user_id, target) VALUES (?, ?)",
+                (user_id, alert['target'])
+            )
+            alert['id'] = cursor.lastrowid
+            self.tracking_users[user_id]['alerts'].append(alert)
+            self._index_alert(user_id, alert)
+            return True
         
-        self.tracking_users[user_id]['alerts'].append({
-            'target': float(target_price),
-            'triggered': False
-        })
-        
-    def check_price_alerts(self, user_id, current_price):
+    def check_price_alerts(self, current_price):
         """
-        Check if any price alerts should be triggered
+        Trigger every pending alert whose target the current price has reached
+        
+        :param current_price: Latest Worldcoin price in USD
+        :return: Dict mapping user ID to a list of triggered alerts
         """
-        if user_id not in self.tracking_users:
-            return []
-            
-        messages = []
-        user_data = self.tracking_users[user_id]
+        with self._alerts_lock:
+            count = bisect_right(self._alert_targets, current_price)
+            if not count:
+                return {}
+            hits = self._alert_entries[:count]
+            del self._alert_targets[:count]
+            del self._alert_entries[:count]
         
-        for alert in user_data['alerts']:
-            if not alert['triggered']:
-                if current_price >= alert['target']:
-                    messages.append(
-                        f"🎯 Price Alert: Worldcoin has reached ${current_price}\n"
-                        f"Your target price was: ${alert['target']}"
-                    )
-                    alert['triggered'] = True
+        triggered = {}
+        for user_id, alert in hits:
+            alert['triggered'] = True
+            triggered.setdefault(user_id, []).append(alert)
+        
+        self._db_executemany(
+            "UPDATE alerts SET triggered = 1 WHERE id = ?",
+            [(alert['id'],) for _, alert in hits]
+        )
                     
-        return messages
+        return triggered
         
+    def record_price(self, price):
+        """
+        Add a price sample to the history and refresh the derived statistics and trend
+        
+        :param price: Latest Worldcoin price in USD
+        """
+        self.price_history.append(float(price))  # Oldest sample drops off automatically
+        
+        history = self.price_history
+        self._stats_cache = {
+            'current': history[-1],
+            'high': max(history),
+            'low': min(history),
+            'avg': sum(history) / len(history)
+        }
+        self._trend_label = self._compute_trend_label()
+    
     def get_price_stats(self):
         """
-        Calculate price statistics
+        Format price statistics computed by record_price
         """
-        if not self.price_history:
+        stats = self._stats_cache
+        if not stats:
             return "No price data available"
-            
-        current = self.price_history[-1]
-        high = max(self.price_history)
-        low = min(self.price_history)
-        avg = sum(self.price_history) / len(self.price_history)
         
         return (
             f"📊 Worldcoin Price Statistics:\n"
-            f"Current: ${current:.2f}\n"
-            f"24h High: ${high:.2f}\n"
-            f"24h Low: ${low:.2f}\n"
-            f"24h Average: ${avg:.2f}"
+            f"Current: ${stats['current']:.2f}\n"
+            f"24h High: ${stats['high']:.2f}\n"
+            f"24h Low: ${stats['low']:.2f}\n"
+            f"24h Average: ${stats['avg']:.2f}"
         )
     
     def start_price_tracking(self, user_id, initial_price=None):
@@ -146,22 +636,19 @@ class WorldcoinTelegramBot:
         :param initial_price: Initial price to start tracking from
         """
         try:
-            if user_id not in self.tracking_users:
-                current_price = self.get_worldcoin_price()
-                if current_price is None:
-                    logger.error("Failed to start price tracking: Could not fetch initial price")
-                    return False
-                
-                self.tracking_users[user_id] = {
-                    'last_notification_price': initial_price or int(current_price),
-                    'tracking': True,
-                    'alerts': []
-                }
-                logger.info(f"Started price tracking for user {user_id}")
-                return True
-            return False
+            with self._users_lock:
+                if user_id not in self.tracking_users:
+                    current_price = self.get_worldcoin_price()
+                    if current_price is None:
+                        logger.error("Failed to start price tracking: No price available yet")
+                        return False
+                    
+                    self._add_user(user_id, initial_price or float(current_price))
+                    logger.info("Started price tracking for user %s", user_id)
+                    return True
+                return False
         except Exception as e:
-            logger.error(f"Error in start_price_tracking for user {user_id}: {e}")
+            logger.error("Error in start_price_tracking for user %s: %s", user_id, e)
             return False
     
     def stop_price_tracking(self, user_id):
@@ -170,62 +657,134 @@ class WorldcoinTelegramBot:
         
         :param user_id: Telegram user ID
         """
-        if user_id in self.tracking_users:
-            self.tracking_users[user_id]['tracking'] = False
-            del self.tracking_users[user_id]
-            return True
-        return False
+        with self._users_lock:
+            if user_id in self.tracking_users:
+                self.tracking_users[user_id]['tracking'] = False
+                del self.tracking_users[user_id]
+                
+                with self._db_lock, self.db:
+                    self.db.execute("DELETE FROM alerts WHERE user_id = ?", (user_id,))
+                    self.db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+                
+                with self._alerts_lock:
+                    kept = [
+                        (target, entry)
+                        for target, entry in zip(self._alert_targets, self._alert_entries)
+                        if entry[0] != user_id
+                    ]
+                    self._alert_targets = [target for target, _ in kept]
+                    self._alert_entries = [entry for _, entry in kept]
+                
+                self._update_notify_floor()
+                
+                with self._chat_buckets_lock:
+                    self._chat_buckets.pop(user_id, None)
+                return True
+            return False
     
     def continuous_price_check(self):
         """
         Continuously check Worldcoin price with robust error handling
         """
-        while True:
+        next_tick = time.monotonic()
+        while not self._price_stop.is_set():
             try:
-                current_price = self.get_worldcoin_price()
+                current_price = self.refresh_price()
                 
                 if current_price is not None:
                     # Update price history
-                    self.price_history.append(float(current_price))
-                    if len(self.price_history) > 24:  # Keep last 24 hours
-                        self.price_history.pop(0)
+                    self.record_price(current_price)
+                    
+                    # Evaluate custom alerts for all users at once
+                    triggered_alerts = self.check_price_alerts(current_price)
+                    
+                    now = time.time()  # Wall clock, so the notice interval survives restarts
+                    
+                    if current_price - self._min_notify_floor >= 1.0:
+                        # Snapshot only the keys; handlers may add or remove users meanwhile
+                        with self._users_lock:
+                            user_ids = tuple(self.tracking_users)
+                    else:
+                        # Nobody is due a $1 notice, so only users with fired alerts need a message
+                        user_ids = tuple(triggered_alerts)
+                    notice_rows = []  # (price, at, user_id) for users getting a $1 notice
+                    batches = []  # (user_id, texts, undo) to queue once state is saved
                     
                     # Check alerts for each user
-                    for user_id, user_data in list(self.tracking_users.items()):
-                        if user_data['tracking']:
-                            # Check regular price increase
-                            if int(current_price) > user_data['last_notification_price']:
-                                try:
-                                    message = (
-                                        f"🚨 Worldcoin Price Alert 🚨\n\n"
-                                        f"Current Price: ${current_price}\n"
-                                        f"Price has increased by $1 since last check!"
-                                    )
-                                    self.bot.send_message(user_id, message)
-                                    user_data['last_notification_price'] = int(current_price)
-                                except Exception as send_error:
-                                    logger.error(f"Message send error to {user_id}: {send_error}")
+                    for user_id in user_ids:
+                        user_data = self.tracking_users.get(user_id)
+                        if user_data and user_data['tracking']:
+                            parts = []
+                            
+                            # Check regular price increase, ignoring small swings and rapid repeats
+                            last_at = user_data['last_notification_at']
+                            price_increased = (
+                                current_price - user_data['last_notification_price'] >= 1.0
+                                and (last_at is None or now - last_at >= self.notification_min_interval)
+                            )
+                            if price_increased:
+                                parts.append(
+                                    f"🚨 Worldcoin Price Alert 🚨\n\n"
+                                    f"Current Price: ${current_price}\n"
+                                    f"Price has increased by $1 since last check!"
+                                )
                             
                             # Check custom price alerts
-                            alert_messages = self.check_price_alerts(user_id, current_price)
-                            for msg in alert_messages:
-                                try:
-                                    self.bot.send_message(user_id, msg)
-                                except Exception as send_error:
-                                    logger.error(f"Alert message send error to {user_id}: {send_error}")
-                
-                time.sleep(self.price_check_interval)
+                            user_alerts = triggered_alerts.get(user_id, [])
+                            parts.extend(
+                                f"🎯 Price Alert: Worldcoin has reached ${current_price}\n"
+                                f"Your target price was: ${alert['target']}"
+                                for alert in user_alerts
+                            )
+                            
+                            if not parts:
+                                continue
+                            
+                            # State to restore if this batch is dropped or fails to send
+                            undo = {
+                                'price': user_data['last_notification_price'],
+                                'at': user_data['last_notification_at'],
+                                'notified_at': now if price_increased else None,
+                                'alerts': user_alerts
+                            }
+                            
+                            if price_increased:
+                                user_data['last_notification_price'] = float(current_price)
+                                user_data['last_notification_at'] = now
+                                notice_rows.append((user_data['last_notification_price'], now, user_id))
+                            
+                            # Deliver everything triggered this cycle in as few messages as possible
+                            batches.append((user_id, self.join_messages(parts), undo))
+                    
+                    # Save all notices in one transaction before queueing, so a failed
+                    # send's undo is never overwritten by this write
+                    if notice_rows:
+                        self._db_executemany(
+                            "UPDATE users SET last_notification_price = ?, last_notification_at = ? "
+                            "WHERE user_id = ?",
+                            notice_rows
+                        )
+                        self._update_notify_floor()
+                    
+                    for user_id, texts, undo in batches:
+                        self._enqueue(user_id, texts, undo)
             
             except Exception as e:
-                logger.error(f"Continuous check error: {e}")
-                time.sleep(self.price_check_interval)
+                logger.error("Continuous check error: %s", e)
+            
+            # Schedule against a fixed cadence so fetch and send time don't add drift
+            next_tick += self.price_check_interval
+            sleep_for = next_tick - time.monotonic()
+            if sleep_for > 0:
+                self._price_stop.wait(sleep_for)
+            else:
+                next_tick = time.monotonic()
     
     def setup_bot_handlers(self):
         """
         Set up Telegram bot command handlers with improved error logging
         """
-        @self.bot.message_handler(commands=['start'])
-        def send_welcome(message):
+        def send_welcome(message, arg):
             try:
                 welcome_text = (
                     "Welcome to the Worldcoin Price Tracker Bot! 🚀\n\n"
@@ -242,55 +801,52 @@ class WorldcoinTelegramBot:
                 )
                 self.bot.reply_to(message, welcome_text)
             except Exception as e:
-                logger.error(f"Welcome message error: {e}")
+                logger.error("Welcome message error: %s", e)
         
-        @self.bot.message_handler(commands=['track'])
-        def start_tracking(message):
+        def start_tracking(message, arg):
             try:
                 user_id = message.from_user.id
                 if self.start_price_tracking(user_id):
                     self.bot.reply_to(message, "Price tracking started! You'll receive notifications when Worldcoin price increases by $1.")
+                elif user_id in self.tracking_users:
+                    self.bot.reply_to(message, "You are already tracking Worldcoin prices.")
                 else:
-                    current_price = self.get_worldcoin_price()
-                    if current_price is None:
-                        self.bot.reply_to(message, "Sorry, I couldn't start tracking prices right now. Please try again later.")
-                    else:
-                        self.bot.reply_to(message, "You are already tracking Worldcoin prices.")
+                    self.bot.reply_to(message, WARMING_UP_MESSAGE)
             except Exception as e:
-                logger.error(f"Track command error: {e}")
+                logger.error("Track command error: %s", e)
                 self.bot.reply_to(message, "An error occurred while starting price tracking. Please try again later.")
         
-        @self.bot.message_handler(commands=['stop'])
-        def stop_tracking(message):
+        def stop_tracking(message, arg):
             user_id = message.from_user.id
             if self.stop_price_tracking(user_id):
                 self.bot.reply_to(message, "Price tracking stopped.")
             else:
                 self.bot.reply_to(message, "You are not currently tracking prices.")
         
-        @self.bot.message_handler(commands=['price'])
-        def current_price(message):
+        def current_price(message, arg):
             price = self.get_worldcoin_price()
             if price:
                 self.bot.reply_to(message, f"Current Worldcoin Price: ${price}")
             else:
-                self.bot.reply_to(message, "Unable to fetch current price.")
+                self.bot.reply_to(message, WARMING_UP_MESSAGE)
         
-        @self.bot.message_handler(commands=['setalert'])
-        def set_alert(message):
+        def set_alert(message, arg):
             try:
-                args = message.text.split()
-                if len(args) != 2:
+                args = arg.split() if arg else []
+                if len(args) != 1:
                     self.bot.reply_to(message, "Usage: /setalert <price>\nExample: /setalert 10.50")
                     return
                 
                 try:
-                    target_price = float(args[1])
+                    target_price = float(args[0])
                     if target_price <= 0:
                         self.bot.reply_to(message, "Please enter a positive price value")
                         return
                         
-                    self.set_price_alert(message.from_user.id, target_price)
+                    if not self.set_price_alert(message.from_user.id, target_price):
+                        self.bot.reply_to(message, WARMING_UP_MESSAGE)
+                        return
+                    
                     self.bot.reply_to(
                         message,
                         f"✅ Alert set! You'll be notified when Worldcoin reaches ${target_price}"
@@ -298,10 +854,9 @@ class WorldcoinTelegramBot:
                 except ValueError:
                     self.bot.reply_to(message, "Invalid price value. Please enter a number.")
             except Exception as e:
-                logger.error(f"Set alert error: {e}")
+                logger.error("Set alert error: %s", e)
                 
-        @self.bot.message_handler(commands=['alerts'])
-        def list_alerts(message):
+        def list_alerts(message, arg):
             try:
                 user_id = message.from_user.id
                 if user_id not in self.tracking_users or not self.tracking_users[user_id]['alerts']:
@@ -315,23 +870,40 @@ class WorldcoinTelegramBot:
                     
                 self.bot.reply_to(message, alerts_text)
             except Exception as e:
-                logger.error(f"List alerts error: {e}")
+                logger.error("List alerts error: %s", e)
                 
-        @self.bot.message_handler(commands=['trend'])
-        def show_trend(message):
+        def show_trend(message, arg):
             try:
                 trend = self.get_price_trend()
                 self.bot.reply_to(message, f"Worldcoin Price Trend:\n{trend}")
             except Exception as e:
-                logger.error(f"Show trend error: {e}")
+                logger.error("Show trend error: %s", e)
                 
-        @self.bot.message_handler(commands=['stats'])
-        def show_stats(message):
+        def show_stats(message, arg):
             try:
                 stats = self.get_price_stats()
                 self.bot.reply_to(message, stats)
             except Exception as e:
-                logger.error(f"Show stats error: {e}")
+                logger.error("Show stats error: %s", e)
+        
+        dispatch = {
+            'start': send_welcome,
+            'track': start_tracking,
+            'stop': stop_tracking,
+            'price': current_price,
+            'setalert': set_alert,
+            'alerts': list_alerts,
+            'trend': show_trend,
+            'stats': show_stats
+        }
+        
+        # Route every command through one handler instead of one per command
+        @self.bot.message_handler(func=lambda m: m.text is not None and m.text.startswith('/'))
+        def handle_command(message):
+            match = COMMAND_RE.match(message.text)
+            if match:
+                command, arg = match.groups()
+                dispatch[command](message, arg)
     
     def run(self):
         """
@@ -345,16 +917,25 @@ class WorldcoinTelegramBot:
             self.setup_bot_handlers()
             
             # Start continuous price checking in a separate thread
-            price_thread = threading.Thread(target=self.continuous_price_check)
-            price_thread.daemon = True
-            price_thread.start()
+            self._price_thread = threading.Thread(target=self.continuous_price_check)
+            self._price_thread.daemon = True
+            self._price_thread.start()
+            
+            # Start the threads delivering queued notifications
+            for outbox in self._outboxes:
+                sender_thread = threading.Thread(target=self._sender_loop, args=(outbox,))
+                sender_thread.daemon = True
+                sender_thread.start()
+                self._sender_threads.append(sender_thread)
             
             # Start bot polling with error handling
             print("Bot is running. Press Ctrl+C to stop.")
             self.bot.infinity_polling(timeout=10, long_polling_timeout=5)
         except Exception as e:
-            logger.error(f"Error starting bot: {e}")
+            logger.error("Error starting bot: %s", e)
             raise
+        finally:
+            self.close()
 
 def main():
     # Get bot token from environment variable
@@ -367,12 +948,17 @@ def main():
     
     try:
         # Initialize and run the bot
-        bot = WorldcoinTelegramBot(BOT_TOKEN)
+        bot = WorldcoinTelegramBot(
+            BOT_TOKEN,
+            num_threads=int(os.getenv('BOT_WORKER_THREADS', 8)),
+            db_path=os.getenv('DATABASE_PATH', 'bot.db'),
+            sender_threads=int(os.getenv('BOT_SENDER_THREADS', 4))
+        )
         bot.run()
     except KeyboardInterrupt:
         print("\nBot stopped by user")
     except Exception as e:
-        logger.error(f"Error running bot: {e}")
+        logger.error("Error running bot: %s", e)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
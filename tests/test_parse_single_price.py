@@ -0,0 +1,42 @@
+import pytest
+
+from telegram_WC_Bot import WorldcoinTelegramBot
+
+parse = WorldcoinTelegramBot.parse_single_price
+
+
+def test_compact_body():
+    assert parse(b'{"world-coin":{"usd":2.53}}', 'world-coin') == 2.53
+
+
+def test_integer_and_exponent():
+    assert parse(b'{"world-coin":{"usd":3}}', 'world-coin') == 3.0
+    assert parse(b'{"world-coin":{"usd":1.5e-7}}', 'world-coin') == 1.5e-7
+
+
+def test_extra_field_falls_back():
+    body = b'{"world-coin":{"usd":2.53,"usd_24h_change":1.2}}'
+    assert parse(body, 'world-coin') is None
+
+
+def test_whitespace_falls_back():
+    assert parse(b'{"world-coin": {"usd": 2.53}}', 'world-coin') is None
+
+
+def test_other_coin_falls_back():
+    assert parse(b'{"bitcoin":{"usd":2.53}}', 'world-coin') is None
+
+
+@pytest.mark.parametrize('body', [
+    b'',
+    b'{"world-coin":{"usd":',
+    b'{"world-coin":{"usd":2.53',
+])
+def test_truncated_body_falls_back(body):
+    assert parse(body, 'world-coin') is None
+
+
+@pytest.mark.parametrize('number', [b'nan', b'inf', b'-Infinity', b'1_000', b' 2.5', b'+2.5', b'1e999'])
+def test_non_json_numbers_fall_back(number):
+    body = b'{"world-coin":{"usd":' + number + b'}}'
+    assert parse(body, 'world-coin') is None